@@ -1,36 +1,63 @@
 from __future__ import annotations
 
-from dataclasses import asdict, dataclass
+from collections import Counter
+from csv import DictReader, writer
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from gzip import compress, decompress, GzipFile
 from html import escape
-from io import StringIO
+from io import BytesIO, StringIO, TextIOWrapper
 from logging import getLogger
+from operator import attrgetter, itemgetter
 from os import environ
 from pathlib import Path
+from string import Template
 from time import sleep
-from typing import Any, Final
+from typing import Any, Final, TypeVar
 from zoneinfo import ZoneInfo
 
 from boto3 import client
 from botocore.exceptions import ClientError
-from jinja2 import StrictUndefined, Template
-from pandas import DataFrame, read_csv, Series
+from orjson import loads
 from requests import Response, Session
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import BaseHTTPResponse
 from requests.packages.urllib3.util.retry import Retry
 
 getLogger().setLevel(environ.get("LOG_LEVEL", "INFO"))
 logger = getLogger()
 
 DAYS: Final = timedelta(days=30)
+EASTERN_TIME: Final = ZoneInfo("US/Eastern")
 DATA_BUCKET: Final = environ.get("DATA_BUCKET", "wknc-stats-data")
 DATA_KEY: Final = environ.get("DATA_KEY", "data/spins.csv")
 WEBSITE_BUCKET: Final = environ.get("WEBSITE_BUCKET", "wkncstats.xyz")
 WEBSITE_KEY: Final = environ.get("WEBSITE_KEY", "index.html")
 REQUEST_DELAY_SECONDS: Final = float(environ.get("REQUEST_DELAY_SECONDS", 3))
+# Caps how long a retried 429/503 may wait on the server's Retry-After.
+MAX_RETRY_AFTER_SECONDS: Final = 60.0
+CSV_COLUMNS: Final = ["id", "start", "end", "artist", "song"]
+SORT_THRESHOLD: Final = 500
+SONG_KEY_SEPARATOR: Final = "\x1f"
+
+K = TypeVar("K")
 
 s3 = client("s3")
 
+# The template ships with the deployment package, so load it once per container.
+TEMPLATE: Final = Template(
+    (Path(__file__).parent / "template" / "index.html").read_text(),
+)
+TRENDING_ARTIST_ROW: Final = Template(
+    '<tr><td class="trending-left">$artist</td>'
+    '<td class="trending-right $trend_color">+$value</td></tr>',
+)
+TOP_ARTIST_ROW: Final = Template("<tr><td>$artist</td><td>$value</td></tr>")
+TOP_SONG_ROW: Final = Template(
+    "<tr><td>$song</td><td>$artist</td><td>$value</td></tr>",
+)
+
 
 @dataclass
 class Spin:
@@ -48,40 +75,57 @@ def lambda_handler(event: dict[str, Any], context: dict[str, Any]) -> None:
     update_s3_website(spins)
 
 
-def load_records() -> DataFrame:
+def load_records() -> dict[int, Spin]:
     try:
         obj = s3.get_object(Bucket=DATA_BUCKET, Key=DATA_KEY)
     except ClientError as e:
         if e.response["Error"]["Code"] == "NoSuchKey":
-            return DataFrame()
+            return {}
         else:
             raise
-    body = obj["Body"].read().decode("utf-8")
-    return read_csv(StringIO(body), index_col="id", parse_dates=["start", "end"])
+    body = obj["Body"].read()
+    if obj.get("ContentEncoding") == "gzip":
+        body = decompress(body)
+    body = body.decode("utf-8")
+
+    spins = {}
+    for row in DictReader(StringIO(body)):
+        spin = Spin(
+            id=int(row["id"]),
+            start=datetime.fromisoformat(row["start"]),
+            end=datetime.fromisoformat(row["end"]),
+            artist=row["artist"],
+            song=row["song"],
+        )
+        spins[spin.id] = spin
+    return spins
 
 
-def purge_old_records(spins: DataFrame, boundary: datetime) -> DataFrame:
-    original_length = len(spins)
-    spins = spins[spins["start"] > boundary]
-    spins_removed = original_length - len(spins)
-    logger.info("Removed %d old spins", spins_removed)
-    return spins
+def purge_old_records(spins: dict[int, Spin], boundary: datetime) -> None:
+    """Removes spins that started on or before the boundary, in place."""
+    stale = [key for key, spin in spins.items() if spin.start <= boundary]
+    for key in stale:
+        del spins[key]
+    logger.info("Removed %d old spins", len(stale))
 
 
 def convert_utc_to_et(utc_dt: datetime) -> str:
     """Converts a UTC datetime object to an ET timestamp."""
-    return utc_dt.astimezone(ZoneInfo("US/Eastern")).strftime("%Y-%m-%d %H:%M")
+    return utc_dt.astimezone(EASTERN_TIME).strftime("%Y-%m-%d %H:%M")
 
 
 def parse_utc_string(utc_string: str) -> datetime:
-    return datetime.strptime(utc_string, "%Y-%m-%dT%H:%M:%SZ").replace(
-        tzinfo=timezone.utc,
-    )
+    # fromisoformat is much faster than strptime but accepts more formats, so only
+    # allow the "%Y-%m-%dT%H:%M:%SZ" shape the API returns.
+    if len(utc_string) != 20 or utc_string[10] != "T" or utc_string[-1] != "Z":
+        raise ValueError(f"Unexpected UTC timestamp format: {utc_string}")
+    return datetime.fromisoformat(utc_string).astimezone(timezone.utc)
 
 
 def sanitize(raw: str) -> str:
     max_length: Final = 100
-    return escape(raw)[:max_length]
+    # The separator joins artist and song into a single key in find_top_songs.
+    return escape(raw.replace(SONG_KEY_SEPARATOR, ""))[:max_length]
 
 
 def create_record(raw: dict[str, Any]) -> Spin:
@@ -98,7 +142,7 @@ def create_record(raw: dict[str, Any]) -> Spin:
 
 
 def get_records(resp: Response) -> list[Spin]:
-    json = resp.json()
+    json = loads(resp.content)
     if not isinstance(json, list):
         raise ValueError(
             f"Could not parse response format. Expected list but was {type(json)}",
@@ -113,22 +157,51 @@ def get_records(resp: Response) -> list[Spin]:
     return records
 
 
-def http():
-    retry_strategy = Retry(
+class CappedRetry(Retry):
+    """Retry that caps Retry-After so a 429 or 503 cannot outlast the Lambda timeout."""
+
+    def get_retry_after(self, response: BaseHTTPResponse) -> float | None:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+
+
+@lru_cache(maxsize=1)
+def http() -> Session:
+    """Returns a shared session so pooled connections are reused across requests."""
+    retry_strategy = CappedRetry(
         total=5,
         backoff_factor=1,
         status_forcelist=[429, 500, 502, 503, 504],
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(
+        max_retries=retry_strategy,
+        pool_connections=1,
+        pool_maxsize=4,
+    )
     http = Session()
     http.mount("https://", adapter)
     return http
 
 
+def rate_limit_delay(response: Response) -> float:
+    """Returns the delay before the next request.
+
+    The next request is sent immediately when the API reports remaining capacity,
+    otherwise requests are spaced by REQUEST_DELAY_SECONDS.
+    """
+    remaining = response.headers.get("X-RateLimit-Remaining", "")
+    if remaining.isdigit() and int(remaining) > 0:
+        return 0.0
+    return REQUEST_DELAY_SECONDS
+
+
 def make_spin_request(
     start: datetime,
     end: datetime,
-) -> list[Spin]:
+) -> tuple[list[Spin], float]:
+    """Returns the spins in the window and the delay before the next request."""
     logger.info("Fetching spins from %s to %s...", start, end)
 
     params: dict[str, int | str] = {
@@ -140,93 +213,163 @@ def make_spin_request(
         "https://wknc.org/wp-json/wknc/v1/spins",
         params=params,
     )
-    response.raise_for_status()
+    # The retry adapter already handles retryable statuses; only other errors reach here.
+    if not response.ok:
+        response.raise_for_status()
 
+    delay = rate_limit_delay(response)
     spins = get_records(response)
     logger.info("Fetched %d spins from %s to %s", len(spins), start, end)
-    return spins
+    return spins, delay
 
 
-def fetch_new_records(start: datetime, end: datetime) -> DataFrame:
-    spins = make_spin_request(start, end)
+def fetch_new_records(start: datetime, end: datetime) -> dict[int, Spin]:
+    spins, delay = make_spin_request(start, end)
 
     # The API returns a max of 100 records per request.
     MAX_RECORDS_PER_RESPONSE: Final = 100
 
     # Keep requesting a shorter time window until all of the records are returned.
     spins_in_response = len(spins)
+    earliest_time = min(spins, key=attrgetter("start")).start if spins else end
     while spins_in_response == MAX_RECORDS_PER_RESPONSE:
-        sleep(REQUEST_DELAY_SECONDS)
-        earliest_time = min([spin.start for spin in spins])
-        next_spins = make_spin_request(start, earliest_time)
+        sleep(delay)
+        next_spins, delay = make_spin_request(start, earliest_time)
         spins_in_response = len(next_spins)
         spins += next_spins
+        if next_spins:
+            batch_earliest = min(next_spins, key=attrgetter("start")).start
+            earliest_time = min(earliest_time, batch_earliest)
 
-    df = DataFrame([asdict(s) for s in spins]).set_index("id")
-    return df[~df.index.duplicated(keep="first")]  # Dedup by index
+    records: dict[int, Spin] = {}
+    for spin in spins:
+        records.setdefault(spin.id, spin)  # Dedup by id
+    return records
 
 
-def update_records(spins: DataFrame) -> DataFrame:
+def update_records(spins: dict[int, Spin]) -> dict[int, Spin]:
     now = datetime.now(timezone.utc)
     boundary = now - DAYS
 
-    if not spins.empty:
-        spins = purge_old_records(spins, boundary)
+    if spins:
+        purge_old_records(spins, boundary)
 
-    start = boundary if spins.empty else spins["start"].max()
-    new_spins = fetch_new_records(start, now)
-    return spins.combine_first(new_spins)
+    start = max(spins.values(), key=attrgetter("start")).start if spins else boundary
+    spins.update(fetch_new_records(start, now))
+    return spins
 
 
-def find_trending_artists(spins: DataFrame, top_k: int) -> Series:
-    middle = spins["start"].max() - DAYS / 2
-    recent_artists = spins[spins["start"] > middle]["artist"].value_counts()
-    old_artists = spins[spins["start"] < middle]["artist"].value_counts()
-    return (
-        recent_artists.sub(old_artists, fill_value=0)
-        .astype("int64")
-        .sort_values(ascending=False)
-        .head(top_k)
-    )
+def most_common(counter: Counter[K], n: int) -> list[tuple[K, int]]:
+    """Returns the n most common elements of the counter.
+
+    Counter.most_common uses a heap, which is slower than a full sort for the few
+    hundred artists and songs typically counted here.
+    """
+    if len(counter) < SORT_THRESHOLD:
+        return sorted(counter.items(), key=itemgetter(1), reverse=True)[:n]
+    return counter.most_common(n)
+
+
+def find_trending_artists(spins: dict[int, Spin], top_k: int) -> dict[str, int]:
+    middle = max(spins.values(), key=attrgetter("start")).start - DAYS / 2
+    scores: Counter[str] = Counter()
+    for spin in spins.values():
+        if spin.start > middle:
+            scores[spin.artist] += 1
+        elif spin.start < middle:
+            scores[spin.artist] -= 1
+    return dict(most_common(scores, top_k))
 
 
-def update_s3_csv(spins: DataFrame) -> None:
+def update_s3_csv(spins: dict[int, Spin]) -> None:
     logger.info("Writing spins to s3...")
-    csv_buffer = StringIO()
-    spins.to_csv(csv_buffer)
+    # Stream the CSV through gzip so only the compressed bytes are held in memory.
+    csv_buffer = BytesIO()
+    with TextIOWrapper(
+        GzipFile(fileobj=csv_buffer, mode="wb", compresslevel=6),
+        encoding="utf-8",
+        newline="",
+    ) as csv_file:
+        csv_writer = writer(csv_file, lineterminator="\n")
+        csv_writer.writerow(CSV_COLUMNS)
+        for spin in spins.values():
+            csv_writer.writerow(
+                [
+                    spin.id,
+                    spin.start.isoformat(),
+                    spin.end.isoformat(),
+                    spin.artist,
+                    spin.song,
+                ],
+            )
+    csv_buffer.seek(0)
     s3.put_object(
-        Body=csv_buffer.getvalue(),
+        Body=csv_buffer,
         Bucket=DATA_BUCKET,
         Key=DATA_KEY,
+        ContentType="text/csv",
+        ContentEncoding="gzip",
     )
     logger.info("Wrote %d spins to s3", len(spins))
 
 
-def find_top_artists(spins: DataFrame, top_k: int) -> Series:
-    return spins["artist"].value_counts().head(top_k)
+def find_top_artists(spins: dict[int, Spin], top_k: int) -> dict[str, int]:
+    return dict(most_common(Counter(spin.artist for spin in spins.values()), top_k))
 
 
-def find_top_songs(spins: DataFrame, top_k: int) -> Series:
-    return spins[["artist", "song"]].value_counts().head(top_k)
+def find_top_songs(spins: dict[int, Spin], top_k: int) -> dict[tuple[str, str], int]:
+    # A single string key hashes faster than an (artist, song) tuple.
+    counts = Counter(
+        f"{spin.artist}{SONG_KEY_SEPARATOR}{spin.song}" for spin in spins.values()
+    )
+    top_songs = {}
+    for key, value in most_common(counts, top_k):
+        artist, _, song = key.partition(SONG_KEY_SEPARATOR)
+        top_songs[(artist, song)] = value
+    return top_songs
 
 
-def update_s3_website(spins: DataFrame) -> None:
-    logger.info("Updating website...")
-    with open(Path("template/index.html.jinja")) as file:
-        template = Template(file.read(), undefined=StrictUndefined)
+def trend_color(value: int) -> str:
+    if value >= 15:
+        return "trend-color-1"
+    elif value >= 10:
+        return "trend-color-2"
+    else:
+        return "trend-color-3"
 
-    data = {
-        "trending_artists": find_trending_artists(spins, 5).to_dict(),
-        "top_artists": find_top_artists(spins, 10).to_dict(),
-        "top_songs": find_top_songs(spins, 10).to_dict(),
-    }
-    html = template.render(data)
+
+def update_s3_website(spins: dict[int, Spin]) -> None:
+    logger.info("Updating website...")
+    trending_artists = find_trending_artists(spins, 5)
+    top_artists = find_top_artists(spins, 10)
+    top_songs = find_top_songs(spins, 10)
+
+    # Artist and song names are escaped by sanitize() when the spins are fetched.
+    html = TEMPLATE.substitute(
+        trending_artists="\n".join(
+            TRENDING_ARTIST_ROW.substitute(
+                artist=artist,
+                trend_color=trend_color(value),
+                value=value,
+            )
+            for artist, value in trending_artists.items()
+        ),
+        top_artists="\n".join(
+            TOP_ARTIST_ROW.substitute(artist=artist, value=value)
+            for artist, value in top_artists.items()
+        ),
+        top_songs="\n".join(
+            TOP_SONG_ROW.substitute(song=song, artist=artist, value=value)
+            for (artist, song), value in top_songs.items()
+        ),
+    )
 
     s3.put_object(
-        Body=html,
+        Body=compress(html.encode("utf-8"), compresslevel=6),
         Bucket=WEBSITE_BUCKET,
         Key=WEBSITE_KEY,
         ContentType="text/html",
+        ContentEncoding="gzip",
     )
     logger.info("Updated website successfully!")
 